@@ -0,0 +1,262 @@
+import hashlib
+import sqlite3
+import tempfile
+from contextlib import closing
+from pathlib import Path
+from typing import Optional
+
+import pandas as pd
+import numpy as np
+
+
+##############################################
+# Incremental rating summaries
+# The video game ratings keep growing, so instead of recomputing every summary over the whole history
+# (as process_amazon_video_game_dataset and process_amazon_video_game_dataset_again do), we persist a small
+# summary state per key (asin or user) and only fold the new ratings (the "delta") into it.
+# The state is persisted in sqlite (part of the python standard library): each key is a row of an indexed table,
+# so folding a delta in only reads and writes the rows of the keys in the delta, and the whole update is one transaction.
+##############################################
+HISTOGRAM_PREFIX = 'hist_'
+ADDITIVE_COLUMNS = ['count', 'sum', 'sum_sq']
+TIME_COLUMNS = ['time_min', 'time_max']
+
+
+def read_ratings(path: Path) -> pd.DataFrame:
+    """
+    This method reads a ratings file (full history or delta) with the same columns as ratings_Video_Games.csv.
+    The user and asin columns are forced to strings, otherwise a delta with only numeric looking asins
+    (e.g. '0700099867') would lose its leading zeros and would not match the keys already in the state.
+    """
+    return pd.read_csv(path, delimiter=',', dtype={'user': str, 'asin': str})
+
+
+def clean_ratings(df: pd.DataFrame) -> pd.DataFrame:
+    """
+    This method applies the first rule of the video game pipelines: the rating has to be between 1.0 and 5.0.
+    Rows without time are kept (they still count in count and review, as in the full pipelines), and min/max time skip them.
+    Time is kept in milliseconds here, as integers are cheaper to merge, and only converted to datetime in the outputs.
+    """
+    df = df[df['review'].between(1, 5)]
+    # a missing time makes pandas read the whole column as float, the nullable integer keeps every delta with the same dtype
+    return df.astype({'time': 'Int64'})
+
+
+def build_rating_summary(df: pd.DataFrame, key: str) -> pd.DataFrame:
+    """
+    This method builds the summary state of the ratings grouped by key.
+    Besides count, sum, sum of squares and min/max time, the state keeps a histogram of the ratings
+    (one column per distinct rating), which is what makes the median mergeable: the ratings are discrete,
+    so adding two histograms gives exactly the histogram of the concatenated ratings.
+    :param df: Ratings dataset (or delta of it)
+    :param key: the column to group by, either asin or user
+    :return: A dataframe indexed by key with the summary state
+    """
+    df = clean_ratings(df).assign(review_sq=lambda d: d['review'] ** 2)
+    grouped = df.groupby(by=key)
+
+    summary = pd.DataFrame({
+        'count': grouped['review'].count(),
+        'sum': grouped['review'].sum(),
+        'sum_sq': grouped['review_sq'].sum(),
+        'time_min': grouped['time'].min(),
+        'time_max': grouped['time'].max(),
+    })
+
+    histogram = df.groupby(by=[key, 'review']).size().unstack(fill_value=0)
+    histogram.columns = [HISTOGRAM_PREFIX + str(float(value)) for value in histogram.columns]
+
+    return _sort_histogram_columns(summary.join(histogram))
+
+
+def load_rating_summary(path: Path) -> pd.DataFrame:
+    """
+    This method reads the whole persisted summary state, indexed by the key it was built with.
+    Notice that this is proportional to the state (not to a delta), as it is only needed to build the outputs.
+    """
+    with closing(sqlite3.connect(str(path))) as connection:
+        summary = pd.read_sql_query('SELECT * FROM summary', connection)
+        # a key without any time comes back from sqlite as NULL, so the times are read as floats
+        summary = summary.set_index(summary.columns[0]).astype({c: 'Int64' for c in TIME_COLUMNS})
+        histogram = pd.read_sql_query('SELECT * FROM histogram', connection)
+
+    histogram = histogram.set_index([histogram.columns[0], 'review'])['n'].unstack(fill_value=0)
+    histogram.columns = [HISTOGRAM_PREFIX + str(float(value)) for value in histogram.columns]
+    # only the histogram is filled with zeros, a key without any time keeps its missing min/max time
+    state = summary.join(histogram).fillna({c: 0 for c in histogram.columns})
+    return _sort_histogram_columns(state.astype({c: 'int64' for c in histogram.columns}))
+
+
+def update_rating_summary(state_path: Path, delta_path: Path, key: str, delta_id: Optional[str] = None,
+                          skip_applied: bool = False) -> pd.DataFrame:
+    """
+    This method folds a delta file into the persisted summary state, in time proportional to the delta:
+    the delta is summarized on its own and then added (upserted) only into the rows of its keys, which sqlite
+    finds through the primary key index. The state is created if it does not exist yet.
+    Each delta is recorded in the state in the same transaction, so applying the same delta twice never counts its
+    ratings twice, and a crash in the middle of an update leaves the previous state untouched.
+    :param state_path: where the summary state is persisted
+    :param delta_path: ratings file with only the new ratings
+    :param key: the column to group by, either asin or user
+    :param delta_id: identifier of the delta, by default the sha256 of the contents of the delta file
+    :param skip_applied: whether a delta that was already applied is skipped (True) or raises a ValueError (False)
+    :return: The summary of the delta alone
+    """
+    delta = build_rating_summary(read_ratings(delta_path), key)
+    if delta_id is None:
+        delta_id = hashlib.sha256(delta_path.read_bytes()).hexdigest()
+
+    # 'with connection' commits the transaction, or rolls it back if anything fails
+    with closing(sqlite3.connect(str(state_path))) as connection, connection:
+        _create_rating_summary_tables(connection, key)
+        try:
+            connection.execute('INSERT INTO applied_deltas VALUES (?)', (delta_id,))
+        except sqlite3.IntegrityError:
+            if skip_applied:
+                return delta
+            raise ValueError(f'Delta {delta_id} was already applied to {state_path}')
+
+        connection.executemany(f"""
+            INSERT INTO summary VALUES (?, ?, ?, ?, ?, ?)
+            ON CONFLICT("{key}") DO UPDATE SET
+                count = count + excluded.count,
+                sum = sum + excluded.sum,
+                sum_sq = sum_sq + excluded.sum_sq,
+                time_min = coalesce(min(time_min, excluded.time_min), time_min, excluded.time_min),
+                time_max = coalesce(max(time_max, excluded.time_max), time_max, excluded.time_max)
+        """, zip(delta.index.tolist(), *[_to_sql_values(delta[c]) for c in ADDITIVE_COLUMNS + TIME_COLUMNS]))
+
+        # only the ratings a key actually has are stored, the histogram is kept in long format (key, review, n)
+        histogram = delta[[c for c in delta.columns if c.startswith(HISTOGRAM_PREFIX)]].stack()
+        histogram = histogram[histogram > 0]
+        connection.executemany(f"""
+            INSERT INTO histogram VALUES (?, ?, ?)
+            ON CONFLICT("{key}", review) DO UPDATE SET n = n + excluded.n
+        """, zip(histogram.index.get_level_values(0).tolist(),
+                 [float(c[len(HISTOGRAM_PREFIX):]) for c in histogram.index.get_level_values(1)],
+                 histogram.tolist()))
+
+    return delta
+
+
+def rating_summary_median(state: pd.DataFrame) -> pd.Series:
+    """
+    This method calculates the median of each key from the histogram of the state.
+    As in pandas, for an even number of ratings the median is the mean of the two middle values.
+    """
+    histogram_columns = [c for c in state.columns if c.startswith(HISTOGRAM_PREFIX)]
+    values = np.array([float(c[len(HISTOGRAM_PREFIX):]) for c in histogram_columns])
+    cumulative = state[histogram_columns].to_numpy().cumsum(axis=1)
+    count = cumulative[:, -1]
+
+    # the value at (0-based) position p is the first value whose cumulative count is larger than p
+    lower = (cumulative > ((count - 1) // 2)[:, None]).argmax(axis=1)
+    upper = (cumulative > (count // 2)[:, None]).argmax(axis=1)
+    return pd.Series((values[lower] + values[upper]) / 2, index=state.index)
+
+
+def rating_summary_std(state: pd.DataFrame) -> pd.Series:
+    """
+    Sample standard deviation (ddof=1, as in pandas) from count, sum and sum of squares.
+    Keys with a single rating get nan, the same as pandas.
+    """
+    count = state['count']
+    variance = (state['sum_sq'] - state['sum'] ** 2 / count) / (count - 1)
+    # clipping avoids tiny negative variances caused by floating point errors
+    return np.sqrt(variance.where(count > 1).clip(lower=0))
+
+
+def rating_summary_to_product_frame(state: pd.DataFrame) -> pd.DataFrame:
+    """
+    This method converts a summary state grouped by asin to the output of process_amazon_video_game_dataset.
+    :return: A dataframe with the columns asin,count,review,time
+    """
+    return pd.DataFrame({
+        'asin': state.index,
+        'count': state['count'].to_numpy(),
+        'review': (state['sum'] / state['count']).to_numpy(),
+        'time': pd.to_datetime(state['time_max'], unit='ms').to_numpy(),
+    })
+
+
+def rating_summary_to_user_frame(state: pd.DataFrame) -> pd.DataFrame:
+    """
+    This method converts a summary state grouped by user to the output of process_amazon_video_game_dataset_again.
+    :return: A dataframe with the same (multi-level) columns as the full recompute
+    """
+    return pd.DataFrame({
+        ('user', ''): state.index,
+        ('asin', 'count_nonzero'): state['count'].to_numpy(),
+        ('review', 'count'): state['count'].to_numpy(),
+        ('review', 'mean'): (state['sum'] / state['count']).to_numpy(),
+        ('review', 'median'): rating_summary_median(state).to_numpy(),
+        ('review', 'std'): rating_summary_std(state).to_numpy(),
+        ('time', 'amin'): pd.to_datetime(state['time_min'], unit='ms').to_numpy(),
+        ('time', 'amax'): pd.to_datetime(state['time_max'], unit='ms').to_numpy(),
+    }).fillna(0)
+
+
+def process_amazon_video_game_dataset_incremental(delta_path: Path, state_path: Path) -> pd.DataFrame:
+    """
+    Incremental version of process_amazon_video_game_dataset: only the ratings in delta_path are read,
+    and the result is the same as recomputing it over the whole history.
+    Running it again with the same delta (e.g. to retry after a failure) does not change the state.
+    """
+    update_rating_summary(state_path, delta_path, 'asin', skip_applied=True)
+    return rating_summary_to_product_frame(load_rating_summary(state_path))
+
+
+def process_amazon_video_game_dataset_again_incremental(delta_path: Path, state_path: Path) -> pd.DataFrame:
+    """
+    Incremental version of process_amazon_video_game_dataset_again: only the ratings in delta_path are read,
+    and the result is the same as recomputing it over the whole history.
+    Notice that here rule 1 is really applied (ratings outside 1.0 and 5.0 are dropped), as in clean_ratings.
+    Running it again with the same delta (e.g. to retry after a failure) does not change the state.
+    """
+    update_rating_summary(state_path, delta_path, 'user', skip_applied=True)
+    return rating_summary_to_user_frame(load_rating_summary(state_path))
+
+
+def _create_rating_summary_tables(connection: sqlite3.Connection, key: str):
+    # the key is recorded in the state, so a state built for asin can not be updated as if it was built for user
+    connection.execute('CREATE TABLE IF NOT EXISTS metadata (name TEXT PRIMARY KEY, value TEXT)')
+    connection.execute("INSERT OR IGNORE INTO metadata VALUES ('key', ?)", (key,))
+    state_key = connection.execute("SELECT value FROM metadata WHERE name = 'key'").fetchone()[0]
+    if state_key != key:
+        raise ValueError(f'The summary state was built for {state_key}, it can not be updated for {key}')
+
+    # the columns have no declared type, so sqlite keeps integers as integers and floats as floats,
+    # the same dtypes a full build would give
+    connection.execute(f'CREATE TABLE IF NOT EXISTS summary ("{key}" TEXT PRIMARY KEY, count, sum, sum_sq, '
+                       f'time_min, time_max)')
+    connection.execute(f'CREATE TABLE IF NOT EXISTS histogram ("{key}" TEXT, review, n, PRIMARY KEY ("{key}", review))')
+    connection.execute('CREATE TABLE IF NOT EXISTS applied_deltas (delta_id TEXT PRIMARY KEY)')
+
+
+def _to_sql_values(column: pd.Series) -> list:
+    # sqlite only binds python values, and missing times (pd.NA) are stored as NULL
+    return [None if pd.isna(value) else value for value in column.tolist()]
+
+
+def _sort_histogram_columns(state: pd.DataFrame) -> pd.DataFrame:
+    histogram_columns = sorted([c for c in state.columns if c.startswith(HISTOGRAM_PREFIX)],
+                               key=lambda c: float(c[len(HISTOGRAM_PREFIX):]))
+    return state[ADDITIVE_COLUMNS + TIME_COLUMNS + histogram_columns]
+
+
+if __name__ == "__main__":
+    ratings_path = Path('..', '..', 'ratings_Video_Games.csv')
+    ratings = read_ratings(ratings_path)
+    with tempfile.TemporaryDirectory() as directory:
+        # applying the two halves of the dataset as deltas must give the same state as a full build
+        halves = [Path(directory, 'first_half.csv'), Path(directory, 'second_half.csv')]
+        ratings.iloc[:len(ratings) // 2].to_csv(halves[0], index=False)
+        ratings.iloc[len(ratings) // 2:].to_csv(halves[1], index=False)
+        for k in ['asin', 'user']:
+            state_path = Path(directory, f'{k}.db')
+            for half in halves:
+                update_rating_summary(state_path, half, k)
+            assert build_rating_summary(ratings, k).sort_index().equals(load_rating_summary(state_path).sort_index())
+
+        assert process_amazon_video_game_dataset_incremental(halves[1], Path(directory, 'asin.db')) is not None
+    print("ok")
@@ -0,0 +1,224 @@
+import json
+import os
+import shutil
+import tempfile
+from pathlib import Path
+from typing import List, Optional
+
+import pandas as pd
+import numpy as np
+
+from assignments.assignment1.b_data_profile import get_numeric_columns
+
+
+##############################################
+# Memory-mapped feature store
+# The frames returned by the process_* methods of e_experimentation are rebuilt on every run and held in RAM
+# by every consumer. Here we export their numeric and encoded columns once, as one contiguous .npy file per column
+# plus a small schema.json header, so that any number of processes can open the same feature set with np.load(mmap_mode='r'):
+# the operating system shares the pages between them, nothing is deserialized, and a column is only read when it is used.
+# Each export writes its columns to a new data-* directory and then replaces schema.json (which points to it) atomically,
+# so the files a reader has mapped are never truncated and a reader always sees one complete export.
+##############################################
+SCHEMA_FILE = 'schema.json'
+SCHEMA_VERSION = 2
+DATA_PREFIX = 'data-'
+OPEN_ATTEMPTS = 5
+
+
+def coerce_numeric_columns(df: pd.DataFrame, numeric_text_columns: Optional[List] = None) -> pd.DataFrame:
+    """
+    This method converts the given text columns to numeric columns, e.g. the value and year columns
+    of process_life_expectancy_dataset, which the transpose and melt leave as objects/strings.
+    Only the named columns are converted, as identifiers that look like numbers (e.g. the asin '0700099867')
+    would silently lose their leading zeros.
+    :param df: Dataset
+    :param numeric_text_columns: the text columns that hold numbers
+    :return: The dataset with the columns converted (the same dataframe if there is nothing to convert)
+    """
+    if not numeric_text_columns:
+        return df
+
+    df_new = df.copy()
+    for column in numeric_text_columns:
+        df_new[column] = pd.to_numeric(df_new[column])
+    return df_new
+
+
+def get_feature_columns(df: pd.DataFrame, numeric_text_columns: Optional[List] = None) -> List:
+    """
+    This method returns the columns that can be stored in the feature store: numeric (normalized values,
+    label and one-hot codes), binary (e.g. large_sepal_lenght) and datetime columns, plus numeric_text_columns
+    (see coerce_numeric_columns). The other text columns are left out, as they can not be memory-mapped
+    without deserializing them.
+    """
+    return _feature_columns(coerce_numeric_columns(df, numeric_text_columns))
+
+
+def export_feature_store(df: pd.DataFrame, path: Path, columns: Optional[List] = None,
+                         numeric_text_columns: Optional[List] = None) -> dict:
+    """
+    This method writes the columns of the dataframe to the feature store directory, replacing any previous export.
+    Notice that the index of the dataframe is not kept (the rows are stored in order), as the process_* methods
+    may have dropped rows and the index has no meaning for the consumers.
+    :param df: Dataset, usually the output of one of the process_* methods
+    :param path: directory of the feature store (created if needed)
+    :param columns: the columns to be exported, by default all the ones from get_feature_columns
+    :param numeric_text_columns: text columns holding numbers, converted before the export (see coerce_numeric_columns)
+    :return: The schema written to the header, with the columns left out of the store in skipped_columns
+    """
+    df = coerce_numeric_columns(df, numeric_text_columns)
+    if columns is None:
+        columns = _feature_columns(df)
+
+    # checking all the columns before writing anything, so a wrong column does not leave a half written store
+    arrays = [np.ascontiguousarray(df[column].to_numpy()) for column in columns]
+    for column, values in zip(columns, arrays):
+        if values.dtype == object:
+            raise ValueError(f'Column {column} is not numeric and can not be stored in the feature store')
+
+    path.mkdir(parents=True, exist_ok=True)
+    previous_data = _previous_data(path)
+    data_path = Path(tempfile.mkdtemp(prefix=DATA_PREFIX, dir=path))
+    schema_path = None
+    schema = {'version': SCHEMA_VERSION, 'rows': len(df), 'data': data_path.name, 'columns': [],
+              'skipped_columns': [c for c in df.columns if c not in columns]}
+    try:
+        for i, (column, values) in enumerate(zip(columns, arrays)):
+            # files are named by position, as the column names (e.g. one-hot feature names) are not always valid
+            # file names
+            file_name = f'{i}.npy'
+            np.save(data_path / file_name, values, allow_pickle=False)
+            schema['columns'].append({'name': column, 'dtype': values.dtype.str, 'file': file_name})
+
+        schema_fd, schema_path = tempfile.mkstemp(prefix=SCHEMA_FILE, dir=path)
+        with open(schema_fd, 'w', encoding='utf-8') as schema_file:
+            json.dump(schema, schema_file, indent=2)
+        # os.replace is atomic: a reader opening the store sees either the previous schema or this one, never half of it
+        os.replace(schema_path, path / SCHEMA_FILE)
+    except BaseException:
+        # a failed export (e.g. a column name json can not write) leaves the store as it was
+        if schema_path is not None and os.path.exists(schema_path):
+            os.unlink(schema_path)
+        shutil.rmtree(data_path, ignore_errors=True)
+        raise
+
+    # the previous export is kept, as a reader may have just read the old schema and not mapped its columns yet.
+    # Older exports (and interrupted ones) are no longer referenced: readers that still have them open keep their
+    # mapped files until they close them (on windows the files in use are just left behind)
+    for old_data_path in path.glob(DATA_PREFIX + '*'):
+        if old_data_path.name not in (data_path.name, previous_data):
+            shutil.rmtree(old_data_path, ignore_errors=True)
+
+    return schema
+
+
+class FeatureStore:
+    """
+    Read-only view of one export of a feature store directory. Opening it reads the schema and memory-maps
+    every column (the data itself is only read from disk when it is used), so the view stays complete and consistent
+    even if the store is exported again. Open the store again to see a newer export.
+    """
+
+    def __init__(self, path: Path):
+        # the export the schema points to may be removed by new exports before its columns are mapped
+        # (only the previous export is kept), in which case the schema is read again
+        for attempt in range(OPEN_ATTEMPTS):
+            schema = _read_schema(path)
+            data_path = path / schema['data']
+            try:
+                # json turns tuples (e.g. the multi-level columns of process_amazon_video_game_dataset_again) into lists
+                arrays = {}
+                for c in schema['columns']:
+                    arrays[_column_name(c['name'])] = _map_column(data_path / c['file'], c['name'], schema['rows'])
+                break
+            except FileNotFoundError:
+                if attempt == OPEN_ATTEMPTS - 1:
+                    raise
+
+        self.path = data_path
+        self.rows = schema['rows']
+        self._arrays = arrays
+        self._dtypes = {_column_name(c['name']): np.dtype(c['dtype']) for c in schema['columns']}
+
+    @property
+    def columns(self) -> List:
+        return list(self._arrays)
+
+    @property
+    def dtypes(self) -> dict:
+        return dict(self._dtypes)
+
+    def __len__(self) -> int:
+        return self.rows
+
+    def __contains__(self, column) -> bool:
+        return column in self._arrays
+
+    def __getitem__(self, column) -> np.ndarray:
+        """
+        This method returns the column as a read-only memory-mapped array (no copy is made)
+        """
+        return self._arrays[column]
+
+    def to_dataframe(self, columns: Optional[List] = None) -> pd.DataFrame:
+        """
+        This method builds a dataframe with the given columns (all by default).
+        Notice that pandas may copy the arrays, so prefer indexing the store directly for large feature sets.
+        """
+        if columns is None:
+            columns = self.columns
+        return pd.DataFrame({column: self[column] for column in columns}, columns=columns)
+
+
+def open_feature_store(path: Path) -> FeatureStore:
+    return FeatureStore(path)
+
+
+def _feature_columns(df: pd.DataFrame) -> List:
+    binary_and_datetime = df.select_dtypes(include=['bool', 'datetime']).columns.tolist()
+    numeric = get_numeric_columns(df)
+    return [c for c in df.columns if c in numeric or c in binary_and_datetime]
+
+
+def _read_schema(path: Path) -> dict:
+    with open(path / SCHEMA_FILE, encoding='utf-8') as schema_file:
+        schema = json.load(schema_file)
+    if schema['version'] != SCHEMA_VERSION:
+        raise ValueError(f'Unsupported feature store version {schema["version"]}')
+    return schema
+
+
+def _previous_data(path: Path) -> Optional[str]:
+    # a missing or unreadable schema (e.g. from an older version of the store) has no export worth keeping
+    try:
+        with open(path / SCHEMA_FILE, encoding='utf-8') as schema_file:
+            return json.load(schema_file).get('data')
+    except (OSError, ValueError):
+        return None
+
+
+def _map_column(file_path: Path, column, rows: int) -> np.ndarray:
+    values = np.load(file_path, mmap_mode='r', allow_pickle=False)
+    if values.ndim != 1 or len(values) != rows:
+        raise ValueError(f'Column {column} has shape {values.shape}, expected ({rows},)')
+    return values
+
+
+def _column_name(name):
+    return tuple(name) if isinstance(name, list) else name
+
+
+if __name__ == "__main__":
+    from assignments.assignment1.e_experimentation import process_iris_dataset_again
+
+    df = process_iris_dataset_again()
+    with tempfile.TemporaryDirectory() as directory:
+        export_feature_store(df, Path(directory))
+        export_feature_store(df, Path(directory))
+        store = open_feature_store(Path(directory))
+        assert store.columns == get_feature_columns(df)
+        assert len(store) == len(df)
+        assert np.array_equal(store['sepal_length'], df['sepal_length'].to_numpy())
+        del store
+    print("ok")
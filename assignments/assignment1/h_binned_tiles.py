@@ -0,0 +1,222 @@
+from typing import List, Optional
+
+import pandas as pd
+import numpy as np
+
+from assignments.assignment1.e_experimentation import process_life_expectancy_dataset, \
+    process_amazon_video_game_dataset
+
+
+##############################################
+# Pre-aggregated binning tiles
+# Every chart (histogram, heatmap, time series) of the cleaned frames needs a full scan of the frame.
+# Here we scan it once after cleaning and keep, per bin and per categorical group, the count, sum, min and max
+# of a value column. The finest bins (level 0) are merged two by two into coarser levels, so a query only reads
+# the level with as many bins as the chart can show, and never touches the rows again.
+##############################################
+TILE_AGGREGATIONS = {'count': 'sum', 'sum': 'sum', 'min': 'min', 'max': 'max'}
+
+
+class BinnedTiles:
+    """
+    Multi-resolution binned aggregates of value_column over column, for each group of group_columns.
+    Bin b of level k covers [origin + b * width * 2**k, origin + (b + 1) * width * 2**k).
+    Use build_binned_tiles to create it.
+    """
+
+    def __init__(self, column: str, value_column: str, group_columns: List[str],
+                 origin: float, width: float, levels: int, is_datetime: bool, is_value_datetime: bool = False):
+        self.column = column
+        self.value_column = value_column
+        self.group_columns = group_columns
+        self.origin = origin
+        self.width = width
+        self.levels = levels
+        self.is_datetime = is_datetime
+        self.is_value_datetime = is_value_datetime
+        self._tiles = []
+
+    def update(self, df: pd.DataFrame):
+        """
+        This method folds new rows (e.g. a new delta of ratings) into the tiles. Only the new rows are binned,
+        and the levels are rebuilt from the finest one, which is much smaller than the data.
+        Since min and max can not be subtracted, rows that changed or were removed need a new build_binned_tiles.
+        """
+        base = self._bin(df)
+        if self._tiles:
+            base = _aggregate(pd.concat([self._tiles[0], base]), self.group_columns)
+
+        self._tiles = [base]
+        for level in range(1, self.levels):
+            coarser = self._tiles[-1].reset_index()
+            coarser['bin'] = coarser['bin'] // 2
+            self._tiles.append(_aggregate(coarser, self.group_columns))
+
+    def level(self, level: int) -> pd.DataFrame:
+        """
+        This method returns the tiles of a level, indexed by the group columns and the bin
+        """
+        return self._tiles[level]
+
+    def query(self, start=None, end=None, max_bins: int = 256) -> pd.DataFrame:
+        """
+        This method answers a histogram/time series query from the tiles. It uses the finest level that shows
+        the range [start, end] (the whole data by default) with at most max_bins bins per group.
+        :param start: first value of the range, in the units of column (numbers or datetimes)
+        :param end: last value of the range, in the units of column
+        :param max_bins: maximum number of bins the chart can show
+        :return: A dataframe with the group columns, bin_start, bin_end, count, sum, min, max and mean
+        """
+        if self._tiles[0].empty:
+            return pd.DataFrame(columns=self.group_columns + ['bin_start', 'bin_end'] + list(TILE_AGGREGATIONS) + ['mean'])
+
+        finest = self._tiles[0].index.get_level_values('bin')
+        first = finest.min() if start is None else self._bin_of(start)
+        last = finest.max() if end is None else self._bin_of(end)
+
+        level = self.levels - 1
+        for k in range(self.levels):
+            if (last >> k) - (first >> k) + 1 <= max_bins:
+                level = k
+                break
+
+        tiles = self._tiles[level].reset_index()
+        tiles = tiles[tiles['bin'].between(first >> level, last >> level)]
+
+        bin_width = self.width * 2 ** level
+        result = tiles[self.group_columns].copy()
+        result['bin_start'] = self._to_column_units(self.origin + tiles['bin'] * bin_width)
+        result['bin_end'] = self._to_column_units(self.origin + (tiles['bin'] + 1) * bin_width)
+        result[list(TILE_AGGREGATIONS)] = tiles[list(TILE_AGGREGATIONS)]
+        result['mean'] = result['sum'] / result['count']
+        if self.is_value_datetime:
+            # the sum of datetimes has no meaning, but their min, max and mean are datetimes again
+            for statistic in ['min', 'max', 'mean']:
+                result[statistic] = pd.to_datetime(result[statistic].round().astype('int64'), unit='ns')
+        return result.reset_index(drop=True)
+
+    def heatmap(self, start=None, end=None, max_bins: int = 256, statistic: str = 'count') -> pd.DataFrame:
+        """
+        This method answers a heatmap query: one row per group, one column per bin (bin_start) with the statistic.
+        """
+        if not self.group_columns:
+            raise ValueError('A heatmap needs at least one group column')
+
+        return self.query(start, end, max_bins).pivot_table(index=self.group_columns, columns='bin_start',
+                                                              values=statistic)
+
+    def _bin(self, df: pd.DataFrame) -> pd.DataFrame:
+        frame = pd.DataFrame({g: df[g].to_numpy() for g in self.group_columns})
+        frame['x'] = _to_numeric(df[self.column]).to_numpy()
+        frame['value'] = _to_numeric(df[self.value_column]).to_numpy()
+        # rows without a position or a value can not be placed in any bin
+        frame = frame.dropna(subset=['x', 'value'])
+
+        frame['bin'] = np.floor((frame['x'] - self.origin) / self.width).astype('int64')
+        # the sum is kept as float, as summing datetimes in integer nanoseconds overflows
+        frame['value_sum'] = frame['value'].astype('float64')
+        # dropna=False keeps the rows with a missing group value as a group of their own
+        return frame.groupby(by=self.group_columns + ['bin'], dropna=False).agg(count=('value', 'count'), sum=('value_sum', 'sum'),
+                                                                  min=('value', 'min'), max=('value', 'max'))
+
+    def _bin_of(self, value) -> int:
+        if self.is_datetime:
+            value = pd.Timestamp(value).value
+        return int(np.floor((value - self.origin) / self.width))
+
+    def _to_column_units(self, values: pd.Series) -> pd.Series:
+        if self.is_datetime:
+            return pd.to_datetime(values.round().astype('int64'), unit='ns')
+        # rounding removes the floating point noise of origin + bin * width (e.g. 0.30000000000000004)
+        return values.round(max(0, -int(np.floor(np.log10(self.width)))) + 6)
+
+
+def build_binned_tiles(df: pd.DataFrame,
+                       column: str,
+                       value_column: Optional[str] = None,
+                       group_columns: Optional[List[str]] = None,
+                       width=None,
+                       levels: int = 8) -> BinnedTiles:
+    """
+    This method builds the tiles of a cleaned dataframe (e.g. the output of one of the process_* methods).
+    :param df: Dataset
+    :param column: the numeric or datetime column to be binned (x axis of the chart)
+    :param value_column: the column aggregated in each bin, by default the binned column itself (as in a histogram)
+    :param group_columns: categorical columns, each combination of them gets its own bins
+    :param width: width of the finest bins (a number, or a timedelta for datetime columns), by default the range
+        of the column divided in 2**levels bins, rounded up to 1, 2 or 5 times a power of 10 (or whole seconds/days)
+    :param levels: number of resolutions, each one with bins twice as wide as the previous one
+    :return: The tiles
+    """
+    value_column = value_column or column
+    is_datetime = pd.api.types.is_datetime64_any_dtype(df[column])
+    x = _to_numeric(df[column])
+    # an empty column has no range, its bins start at 0 (1970-01-01 for datetimes)
+    lowest, highest = (x.min(), x.max()) if x.notna().any() else (0, 0)
+
+    if width is None:
+        width = (highest - lowest) / 2 ** levels if highest > lowest else 1
+        if is_datetime:
+            # whole seconds (or whole days for wider bins) instead of fractions of nanoseconds
+            unit = pd.Timedelta('1D').value if width >= pd.Timedelta('1D').value else pd.Timedelta('1s').value
+            width = max(1, round(width / unit)) * unit
+        else:
+            width = _nice_width(width)
+    elif is_datetime:
+        width = pd.Timedelta(width).value
+
+    # anchoring the bins in a multiple of a round width gives round bin edges (e.g. whole years, whole days, or 0.02)
+    origin = int(lowest) // width * width if is_datetime else np.floor(lowest / width) * width
+    tiles = BinnedTiles(column, value_column, list(group_columns or []), origin, width, levels, is_datetime,
+                        pd.api.types.is_datetime64_any_dtype(df[value_column]))
+    tiles.update(df)
+    return tiles
+
+
+def process_life_expectancy_tiles() -> BinnedTiles:
+    """
+    Tiles of life expectancy by year and hemisphere (the label encoded Latitude column),
+    with one year wide bins at the finest level.
+    """
+    return build_binned_tiles(process_life_expectancy_dataset(), 'year', 'value', ['Latitude'], width=1)
+
+
+def process_amazon_video_game_tiles() -> BinnedTiles:
+    """
+    Tiles of the distribution of the average rating of the products
+    """
+    return build_binned_tiles(process_amazon_video_game_dataset(), 'review', width=0.125, levels=6)
+
+
+def _to_numeric(column: pd.Series) -> pd.Series:
+    """
+    Datetimes are binned as nanoseconds, and text numbers (e.g. the years of the life expectancy dataset) as numbers
+    """
+    if pd.api.types.is_datetime64_any_dtype(column):
+        nanoseconds = pd.Series(column.to_numpy(dtype='datetime64[ns]').view('int64'), index=column.index)
+        # keeping integers when there is no missing value, as floats lose precision with nanoseconds
+        return nanoseconds.where(column.notna()) if column.isna().any() else nanoseconds
+    return pd.to_numeric(column)
+
+
+def _nice_width(width: float) -> float:
+    """
+    The smallest of 1, 2 or 5 times a power of 10 that is not narrower than width, so there are at most as many bins
+    as asked and their edges are round numbers
+    """
+    exponent = int(np.floor(np.log10(width)))
+    for step in [1, 2, 5, 10]:
+        if step * 10.0 ** exponent >= width:
+            return step * 10.0 ** exponent
+
+
+def _aggregate(tiles: pd.DataFrame, group_columns: List[str]) -> pd.DataFrame:
+    return tiles.groupby(by=group_columns + ['bin'], dropna=False).agg(TILE_AGGREGATIONS)
+
+
+if __name__ == "__main__":
+    life_expectancy_tiles = process_life_expectancy_tiles()
+    assert life_expectancy_tiles.query(max_bins=32) is not None
+    assert life_expectancy_tiles.heatmap(statistic='mean') is not None
+    assert process_amazon_video_game_tiles().query() is not None
+    print("ok")